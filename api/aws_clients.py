@@ -0,0 +1,64 @@
+import threading
+import boto3
+from botocore.config import Config
+from typing import Optional
+
+# Larger pool than the default of 10 so concurrent requests and threaded
+# transfers don't queue for connections, with keepalive to reuse them.
+# Timeouts and attempts are bounded so a slow AWS call fails a web request
+# in seconds instead of hanging the worker.
+CLIENT_CONFIG = Config(
+    max_pool_connections=64,
+    tcp_keepalive=True,
+    connect_timeout=5,
+    read_timeout=10,
+    retries={'mode': 'adaptive', 'total_max_attempts': 3}
+)
+
+# boto3 clients and resources are expensive to build (service model loading),
+# so keep one per session, service and region.
+_clients = {}
+_resources = {}
+_lock = threading.Lock()
+
+def _session_key(session: Optional[boto3.Session], service_name: str, config: Config = CLIENT_CONFIG):
+    region = session.region_name if session else None
+    return (session, service_name, region, id(config))
+
+def get_client(service_name: str, session: Optional[boto3.Session] = None, config: Config = CLIENT_CONFIG):
+    """Return a shared low-level client for the session, service and config"""
+    key = _session_key(session, service_name, config)
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            client = (session or boto3).client(service_name, config=config)
+            _clients[key] = client
+        return client
+
+def get_resource(service_name: str, session: Optional[boto3.Session] = None):
+    """Return a shared resource for the session and service"""
+    key = _session_key(session, service_name)
+    with _lock:
+        resource = _resources.get(key)
+        if resource is None:
+            resource = (session or boto3).resource(service_name, config=CLIENT_CONFIG)
+            _resources[key] = resource
+        return resource
+
+def get_dax_client(endpoint_url: str, session: Optional[boto3.Session] = None):
+    """Return a shared DAX client for the cluster endpoint, or None if amazondax isn't installed"""
+    key = (session, 'dax', endpoint_url)
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            try:
+                from amazondax import AmazonDaxClient
+            except ImportError:
+                return None
+            client = AmazonDaxClient(
+                session=session,
+                region_name=session.region_name if session else None,
+                endpoint_url=endpoint_url
+            )
+            _clients[key] = client
+        return client
@@ -1,54 +1,216 @@
+import threading
 import boto3
-from typing import Dict, List, Optional
+from boto3.dynamodb.conditions import Attr
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+from cachetools import TTLCache
+from .aws_clients import get_client, get_dax_client, get_resource
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 import logging
 
+logger = logging.getLogger(__name__)
+
+# Read cache settings for display paths; writers read consistently instead
+LOCATION_CACHE_SIZE = 1024
+LOCATION_CACHE_TTL = 2
+LIST_CACHE_TTL = 5
+_ALL_LOCATIONS = '__all__'
+
+# UpdateExpression and attribute names per set of updated fields
+_UPDATE_TEMPLATES: Dict[frozenset, Tuple[str, Dict[str, str]]] = {}
+
+def _update_template(fields: frozenset) -> Tuple[str, Dict[str, str]]:
+    template = _UPDATE_TEMPLATES.get(fields)
+    if template is None:
+        ordered = sorted(fields)
+        template = (
+            "SET " + ", ".join(f"#{k} = :{k}" for k in ordered),
+            {f"#{k}": k for k in ordered}
+        )
+        _UPDATE_TEMPLATES[fields] = template
+    return template
+
 class DynamoDBQueueStorage:
-    def __init__(self, table_name: str, session: Optional[boto3.Session] = None):
+    def __init__(self, table_name: str, session: Optional[boto3.Session] = None, dax_endpoint: Optional[str] = None):
         self.table_name = table_name
-        self.dynamodb = session.resource('dynamodb') if session else boto3.resource('dynamodb')
+        self.dynamodb = get_resource('dynamodb', session)
         self.table = self.dynamodb.Table(table_name)
-        logging.info(f"Initialized DynamoDB connection to table {table_name}")
+        # Hot paths skip the resource layer and marshal with prebuilt (de)serializers
+        self.client = get_client('dynamodb', session)
+        # Item reads can go through a DAX cluster; writes always go to DynamoDB
+        self.read_client = self.client
+        if dax_endpoint:
+            dax_client = get_dax_client(dax_endpoint, session)
+            if dax_client:
+                self.read_client = dax_client
+                logger.info("Reading items from DAX cluster %s", dax_endpoint)
+            else:
+                logger.warning("DAX endpoint configured but amazondax is not installed, reading from DynamoDB")
+        self._serializer = TypeSerializer()
+        self._deserializer = TypeDeserializer()
+        self._cache_lock = threading.RLock()
+        self._cache = TTLCache(maxsize=LOCATION_CACHE_SIZE, ttl=LOCATION_CACHE_TTL)
+        self._list_cache = TTLCache(maxsize=1, ttl=LIST_CACHE_TTL)
+        logger.info("Initialized DynamoDB connection to table %s", table_name)
+
+    def clear_cache(self):
+        """Drop every cached location, e.g. after out-of-band admin changes"""
+        with self._cache_lock:
+            self._cache.clear()
+            self._list_cache.clear()
+
+    def _invalidate(self, location_id: Optional[str]):
+        with self._cache_lock:
+            self._cache.pop(location_id, None)
+            self._list_cache.clear()
+
+    def _store(self, location: Dict):
+        """Write-through: cache a location that was just written successfully"""
+        with self._cache_lock:
+            self._cache[location['location_id']] = location
+            self._list_cache.clear()
+
+    def _deserialize(self, item: Dict) -> Dict:
+        deserialize = self._deserializer.deserialize
+        return {k: deserialize(v) for k, v in item.items()}
+
+    def iter_locations(self) -> Iterator[Dict]:
+        """Yield all locations from DynamoDB, following scan pagination"""
+        with self._cache_lock:
+            cached = self._list_cache.get(_ALL_LOCATIONS)
+        if cached is not None:
+            yield from cached
+            return
+
+        scan_kwargs = {}
+        while True:
+            response = self.table.scan(**scan_kwargs)
+            yield from response.get('Items', [])
+            last_evaluated_key = response.get('LastEvaluatedKey')
+            if not last_evaluated_key:
+                break
+            scan_kwargs['ExclusiveStartKey'] = last_evaluated_key
 
     def list_locations(self) -> List[Dict]:
         """Get all locations from DynamoDB"""
         try:
-            response = self.table.scan()
-            locations = response.get('Items', [])
-            logging.debug(f"Retrieved {len(locations)} locations from DynamoDB")
+            with self._cache_lock:
+                cached = self._list_cache.get(_ALL_LOCATIONS)
+            if cached is not None:
+                return list(cached)
+
+            locations = list(self.iter_locations())
+            with self._cache_lock:
+                self._list_cache[_ALL_LOCATIONS] = locations
+            logger.debug("Retrieved %d locations from DynamoDB", len(locations))
             return locations
         except Exception as e:
-            logging.error(f"Error listing locations from DynamoDB: {str(e)}")
+            logger.error("Error listing locations from DynamoDB: %s", e)
             raise
 
-    def get_location(self, location_id: str) -> Optional[Dict]:
-        """Get a specific location from DynamoDB"""
+    def count_locations(self) -> Tuple[int, int]:
+        """Count all locations and those with people waiting, without reading items back"""
         try:
-            response = self.table.get_item(Key={'location_id': location_id})
-            location = response.get('Item')
+            # With a filter, Count is the matching items and ScannedCount all items
+            scan_kwargs = {'Select': 'COUNT', 'FilterExpression': Attr('active_waiting').gt(0)}
+            total = 0
+            active = 0
+            while True:
+                response = self.table.scan(**scan_kwargs)
+                total += response.get('ScannedCount', 0)
+                active += response.get('Count', 0)
+                last_evaluated_key = response.get('LastEvaluatedKey')
+                if not last_evaluated_key:
+                    break
+                scan_kwargs['ExclusiveStartKey'] = last_evaluated_key
+            logger.debug("Counted %d locations, %d active, in DynamoDB", total, active)
+            return total, active
+        except Exception as e:
+            logger.error("Error counting locations in DynamoDB: %s", e)
+            raise
+
+    def get_location(self, location_id: str, consistent: bool = False) -> Optional[Dict]:
+        """Get a specific location from DynamoDB
+
+        With consistent, the cache and DAX are bypassed for a strongly
+        consistent read; use it before changing the location.
+        """
+        try:
+            if consistent:
+                response = self.client.get_item(
+                    TableName=self.table_name,
+                    Key={'location_id': {'S': location_id}},
+                    ConsistentRead=True
+                )
+            else:
+                with self._cache_lock:
+                    location = self._cache.get(location_id)
+                if location is not None:
+                    return location
+                response = self.read_client.get_item(
+                    TableName=self.table_name,
+                    Key={'location_id': {'S': location_id}}
+                )
+            item = response.get('Item')
+            location = self._deserialize(item) if item else None
             if location:
-                logging.debug(f"Retrieved location {location_id} from DynamoDB")
+                with self._cache_lock:
+                    self._cache[location_id] = location
+                logger.debug("Retrieved location %s from DynamoDB", location_id)
             else:
-                logging.debug(f"Location {location_id} not found in DynamoDB")
+                logger.debug("Location %s not found in DynamoDB", location_id)
             return location
         except Exception as e:
-            logging.error(f"Error getting location {location_id} from DynamoDB: {str(e)}")
+            logger.error("Error getting location %s from DynamoDB: %s", location_id, e)
             raise
 
-    def put_location(self, location: Dict) -> bool:
-        """Save a location to DynamoDB"""
+    def put_location(self, location: Dict, expected_updated_at: Optional[str] = None) -> bool:
+        """Save a location to DynamoDB
+
+        With expected_updated_at, the write only happens if the stored item
+        still has that updated_at; returns False when it has changed.
+        """
+        params = {'Item': location}
+        if expected_updated_at is not None:
+            params['ConditionExpression'] = Attr('updated_at').eq(expected_updated_at)
         try:
-            self.table.put_item(Item=location)
-            logging.debug(f"Saved location {location.get('location_id')} to DynamoDB")
-            return True
+            self.table.put_item(**params)
+        except self.table.meta.client.exceptions.ConditionalCheckFailedException:
+            logger.debug("Location %s changed in DynamoDB, not saved", location.get('location_id'))
+            self._invalidate(location.get('location_id'))
+            return False
         except Exception as e:
-            logging.error(f"Error saving location to DynamoDB: {str(e)}")
+            logger.error("Error saving location to DynamoDB: %s", e)
+            # Drop cached copies, callers may have mutated them
+            self._invalidate(location.get('location_id'))
+            raise
+        self._store(location)
+        logger.debug("Saved location %s to DynamoDB", location.get('location_id'))
+        return True
+
+    def put_locations_if_unchanged(self, locations: Iterable[Dict]) -> Tuple[int, int]:
+        """Save locations one conditional put at a time, skipping any changed since they were read
+
+        BatchWriteItem can't carry conditions, so these are single PutItem
+        calls. Returns the number of locations saved and the number skipped.
+        """
+        saved = skipped = 0
+        try:
+            for location in locations:
+                # A blind overwrite of a stale copy would drop other instances' changes
+                if self.put_location(location, location.get('updated_at')):
+                    saved += 1
+                else:
+                    skipped += 1
+            logger.debug("Saved %d locations to DynamoDB, skipped %d changed ones", saved, skipped)
+            return saved, skipped
+        except Exception as e:
+            logger.error("Error saving locations to DynamoDB: %s", e)
             raise
 
     def update_location(self, location_id: str, updates: Dict) -> bool:
         """Update a location in DynamoDB"""
         try:
-            update_expression = "SET " + ", ".join(f"#{k} = :{k}" for k in updates.keys())
-            expression_attribute_names = {f"#{k}": k for k in updates.keys()}
+            update_expression, expression_attribute_names = _update_template(frozenset(updates))
             expression_attribute_values = {f":{k}": v for k, v in updates.items()}
 
             self.table.update_item(
@@ -57,18 +219,61 @@ class DynamoDBQueueStorage:
                 ExpressionAttributeNames=expression_attribute_names,
                 ExpressionAttributeValues=expression_attribute_values
             )
-            logging.debug(f"Updated location {location_id} in DynamoDB")
+            logger.debug("Updated location %s in DynamoDB", location_id)
             return True
         except Exception as e:
-            logging.error(f"Error updating location in DynamoDB: {str(e)}")
+            logger.error("Error updating location in DynamoDB: %s", e)
+            raise
+        finally:
+            self._invalidate(location_id)
+
+    def append_queue_entry(self, location_id: str, entry: Dict, updated_at: str, location: Optional[Dict] = None,
+                           waiting_before: int = 0) -> bool:
+        """Append a queue entry to a location in a single atomic update
+
+        location is the caller's copy with the entry already appended; it
+        replaces the cached item once the update succeeds. waiting_before is
+        the caller's count of waiting entries before this one, used as the
+        counter on items written before active_waiting existed.
+        """
+        try:
+            serialize = self._serializer.serialize
+            self.client.update_item(
+                TableName=self.table_name,
+                Key={'location_id': {'S': location_id}},
+                UpdateExpression=(
+                    "SET current_queue = list_append(if_not_exists(current_queue, :empty), :entry), "
+                    "updated_at = :updated_at, "
+                    "active_waiting = if_not_exists(active_waiting, :base) + :one"
+                ),
+                ConditionExpression="attribute_exists(location_id)",
+                ExpressionAttributeValues={
+                    ':empty': {'L': []},
+                    ':entry': {'L': [serialize(entry)]},
+                    ':updated_at': {'S': updated_at},
+                    ':base': {'N': str(waiting_before)},
+                    ':one': {'N': '1'}
+                }
+            )
+        except Exception as e:
+            logger.error("Error appending queue entry in DynamoDB: %s", e)
+            self._invalidate(location_id)
             raise
+        if location is not None:
+            self._store(location)
+        else:
+            self._invalidate(location_id)
+        logger.debug("Appended queue entry to location %s in DynamoDB", location_id)
+        return True
 
     def delete_location(self, location_id: str) -> bool:
         """Delete a location from DynamoDB"""
         try:
             self.table.delete_item(Key={'location_id': location_id})
-            logging.debug(f"Deleted location {location_id} from DynamoDB")
+            logger.debug("Deleted location %s from DynamoDB", location_id)
             return True
         except Exception as e:
-            logging.error(f"Error deleting location from DynamoDB: {str(e)}")
+            logger.error("Error deleting location from DynamoDB: %s", e)
             raise
+        finally:
+            self._invalidate(location_id)
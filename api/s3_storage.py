@@ -1,68 +1,119 @@
 import boto3
 import os
 import logging
-from typing import Optional
+import threading
+import time
+from boto3.s3.transfer import TransferConfig
+from cachetools import LRUCache
+from botocore.config import Config
+from .aws_clients import CLIENT_CONFIG, get_client
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+# Presigned URLs are reused until this many seconds before they expire, so a
+# handed-out URL stays valid for at least that long
+URL_CACHE_SIZE = 4096
+URL_REFRESH_MARGIN = 600
+
+# Uploads carry user files that are costly to lose, so allow a couple more
+# attempts than other calls
+S3_CLIENT_CONFIG = CLIENT_CONFIG.merge(Config(retries={'mode': 'adaptive', 'total_max_attempts': 5}))
 
 class S3Storage:
     def __init__(self, bucket_name: str, session: Optional[boto3.Session] = None):
         self.bucket_name = bucket_name
-        self.s3 = session.client('s3') if session else boto3.client('s3')
-        logging.info(f"Initialized S3 connection to bucket {bucket_name}")
+        self.s3 = get_client('s3', session, S3_CLIENT_CONFIG)
+        # Parallel multipart transfers for anything above the threshold
+        self.transfer_config = TransferConfig(
+            multipart_threshold=8 * MB,
+            multipart_chunksize=16 * MB,
+            max_concurrency=16,
+            use_threads=True
+        )
+        self._url_lock = threading.Lock()
+        self._url_cache = LRUCache(maxsize=URL_CACHE_SIZE)
+        logger.info("Initialized S3 connection to bucket %s", bucket_name)
 
-    def upload_file(self, file_path: str, s3_key: str) -> bool:
+    def upload_file(self, file_path: str, s3_key: str, extra_args: Optional[Dict] = None) -> bool:
         """Upload a file to S3"""
         try:
-            self.s3.upload_file(file_path, self.bucket_name, s3_key)
-            logging.debug(f"Uploaded {file_path} to s3://{self.bucket_name}/{s3_key}")
+            self.s3.upload_file(file_path, self.bucket_name, s3_key, ExtraArgs=extra_args, Config=self.transfer_config)
+            logger.debug("Uploaded %s to s3://%s/%s", file_path, self.bucket_name, s3_key)
             return True
         except Exception as e:
-            logging.error(f"Error uploading file to S3: {str(e)}")
+            logger.error("Error uploading file to S3: %s", e)
             raise
 
     def download_file(self, s3_key: str, local_path: str) -> bool:
         """Download a file from S3"""
         try:
-            # Ensure directory exists
-            os.makedirs(os.path.dirname(local_path), exist_ok=True)
-            self.s3.download_file(self.bucket_name, s3_key, local_path)
-            logging.debug(f"Downloaded s3://{self.bucket_name}/{s3_key} to {local_path}")
+            try:
+                self._download(s3_key, local_path)
+            except FileNotFoundError:
+                # Only create the directory when it is actually missing
+                directory = os.path.dirname(local_path)
+                if not directory:
+                    raise
+                os.makedirs(directory, exist_ok=True)
+                self._download(s3_key, local_path)
+            logger.debug("Downloaded s3://%s/%s to %s", self.bucket_name, s3_key, local_path)
             return True
         except Exception as e:
-            logging.error(f"Error downloading file from S3: {str(e)}")
+            logger.error("Error downloading file from S3: %s", e)
             raise
 
+    def _download(self, s3_key: str, local_path: str):
+        # TransferManager writes to a temporary file and renames it on success,
+        # so a failed transfer never leaves a partial file at local_path
+        self.s3.download_file(self.bucket_name, s3_key, local_path, Config=self.transfer_config)
+
     def delete_file(self, s3_key: str) -> bool:
         """Delete a file from S3"""
         try:
             self.s3.delete_object(Bucket=self.bucket_name, Key=s3_key)
-            logging.debug(f"Deleted s3://{self.bucket_name}/{s3_key}")
+            with self._url_lock:
+                for cache_key in [k for k in self._url_cache if k[0] == s3_key]:
+                    del self._url_cache[cache_key]
+            logger.debug("Deleted s3://%s/%s", self.bucket_name, s3_key)
             return True
         except Exception as e:
-            logging.error(f"Error deleting file from S3: {str(e)}")
+            logger.error("Error deleting file from S3: %s", e)
             raise
 
-    def upload_file_obj(self, file_obj, s3_key: str) -> bool:
+    def upload_file_obj(self, file_obj, s3_key: str, extra_args: Optional[Dict] = None) -> bool:
         """Upload a file object to S3"""
         try:
             # Reset file pointer to beginning
             file_obj.seek(0)
-            self.s3.upload_fileobj(file_obj, self.bucket_name, s3_key)
-            logging.debug(f"Uploaded file object to s3://{self.bucket_name}/{s3_key}")
+            self.s3.upload_fileobj(file_obj, self.bucket_name, s3_key, ExtraArgs=extra_args, Config=self.transfer_config)
+            logger.debug("Uploaded file object to s3://%s/%s", self.bucket_name, s3_key)
             return True
         except Exception as e:
-            logging.error(f"Error uploading file object to S3: {str(e)}")
+            logger.error("Error uploading file object to S3: %s", e)
             raise
 
     def get_file_url(self, s3_key: str, expiration: int = 3600) -> str:
         """Get a presigned URL for a file"""
         try:
+            cache_key = (s3_key, expiration)
+            now = time.monotonic()
+            with self._url_lock:
+                cached = self._url_cache.get(cache_key)
+            if cached and cached[1] > now:
+                return cached[0]
+
             url = self.s3.generate_presigned_url(
                 'get_object',
                 Params={'Bucket': self.bucket_name, 'Key': s3_key},
                 ExpiresIn=expiration
             )
-            logging.debug(f"Generated presigned URL for s3://{self.bucket_name}/{s3_key}")
+            with self._url_lock:
+                self._url_cache[cache_key] = (url, now + expiration - URL_REFRESH_MARGIN)
+            logger.debug("Generated presigned URL for s3://%s/%s", self.bucket_name, s3_key)
             return url
         except Exception as e:
-            logging.error(f"Error generating presigned URL: {str(e)}")
+            logger.error("Error generating presigned URL: %s", e)
             raise
@@ -1,14 +1,26 @@
+import hashlib
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from decimal import Decimal
 from functools import wraps
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify
+import orjson
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_from_directory
+from flask_caching import Cache
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
+from jinja2 import FileSystemBytecodeCache
+from werkzeug.exceptions import NotFound
+from werkzeug.local import LocalProxy
 from queue_system import QueueSystem
-from models import User, users
+from models import User, users, admins, add_user
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
 
+# Local receipt storage used when S3 is not configured
+RECEIPTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'receipts')
+
 # Initialize Flask app
 app = Flask(__name__, instance_relative_config=True)
 app.config.from_mapping(
@@ -17,9 +29,21 @@ app.config.from_mapping(
     AWS_SECRET_ACCESS_KEY=os.environ.get('AWS_SECRET_ACCESS_KEY'),
     AWS_REGION=os.environ.get('AWS_REGION', 'eu-north-1'),
     DYNAMODB_TABLE=os.environ.get('DYNAMODB_TABLE', 'orderlyqueues'),
-    S3_BUCKET=os.environ.get('S3_BUCKET', 'ctorderly')
+    S3_BUCKET=os.environ.get('S3_BUCKET', 'ctorderly'),
+    DAX_ENDPOINT=os.environ.get('DAX_ENDPOINT')
 )
 
+# Short-lived in-process cache for rapidly polled endpoints
+STATUS_CACHE_TIMEOUT = 3
+INDEX_CACHE_TIMEOUT = 5
+# Must stay below the presigned URL refresh margin in api/s3_storage.py
+QR_REDIRECT_MAX_AGE = 300
+cache = Cache(app, config={'CACHE_TYPE': 'SimpleCache', 'CACHE_DEFAULT_TIMEOUT': INDEX_CACHE_TIMEOUT})
+
+# Password KDF runs here so only a couple of logins hash at once
+HASH_EXECUTOR = ThreadPoolExecutor(max_workers=2, thread_name_prefix='password-hash')
+HASH_TIMEOUT = 2
+
 # Initialize Flask-Login
 login_manager = LoginManager()
 login_manager.init_app(app)
@@ -40,22 +64,56 @@ try:
 except OSError:
     pass
 
-# Initialize queue system
-queue_system = QueueSystem(
-    data_file='queue_data.json',
-    s3_bucket=app.config['S3_BUCKET'],
-    s3_region=app.config['AWS_REGION'],
-    aws_access_key_id=app.config['AWS_ACCESS_KEY_ID'],
-    aws_secret_access_key=app.config['AWS_SECRET_ACCESS_KEY'],
-    dynamodb_table=app.config['DYNAMODB_TABLE']
-)
+# Reuse compiled templates across cold starts instead of re-parsing them.
+# Jinja's default directory lives under the temp dir (writable on Vercel) and
+# is private to this user, so no one else can plant bytecode in it.
+try:
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache()
+except (OSError, RuntimeError):
+    app.logger.warning("Jinja bytecode cache directory unavailable, templates will be compiled per process")
+
+# Initialize queue system on first use, so importing the app (cold start)
+# doesn't wait on AWS credential resolution and the initial location scan
+_queue_system = None
+_queue_system_lock = threading.Lock()
+
+def get_queue_system() -> QueueSystem:
+    global _queue_system
+    if _queue_system is None:
+        with _queue_system_lock:
+            if _queue_system is None:
+                _queue_system = QueueSystem(
+                    data_file='queue_data.msgpack',
+                    s3_bucket=app.config['S3_BUCKET'],
+                    s3_region=app.config['AWS_REGION'],
+                    aws_access_key_id=app.config['AWS_ACCESS_KEY_ID'],
+                    aws_secret_access_key=app.config['AWS_SECRET_ACCESS_KEY'],
+                    dynamodb_table=app.config['DYNAMODB_TABLE'],
+                    dax_endpoint=app.config['DAX_ENDPOINT']
+                )
+    return _queue_system
+
+queue_system = LocalProxy(get_queue_system)
+
+@cache.cached(timeout=INDEX_CACHE_TIMEOUT, key_prefix='idx')
+def cached_index_counts():
+    """Location and active queue counts for the homepage"""
+    return queue_system.get_location_counts()
+
+@cache.cached(timeout=INDEX_CACHE_TIMEOUT, key_prefix='admin_idx')
+def cached_admin_locations():
+    """Location list for the admin dashboard"""
+    return queue_system.get_all_locations()
+
+def invalidate_location_views():
+    """Drop cached location listings after queues or locations change"""
+    cache.delete_many('idx', 'admin_idx')
 
 # Routes
 @app.route('/')
 def index():
-    locations = queue_system.get_all_locations()
-    active_queues = sum(1 for loc in locations if any(entry.get('status') == 'waiting' for entry in loc.get('current_queue', [])))
-    return render_template('index.html', locations=locations, active_queues=active_queues)
+    location_count, active_queues = cached_index_counts()
+    return render_template('index.html', location_count=location_count, active_queues=active_queues)
 
 @app.route('/scan')
 def scanner():
@@ -116,19 +174,19 @@ def check_status():
 
 @app.route('/queue/<location_id>')
 def queue_page(location_id):
-    location = queue_system.get_location(location_id)
+    location, _, stats = queue_system.get_location_bundle(location_id)
     if not location:
         flash('Location not found', 'error')
         return redirect(url_for('index'))
-    stats = queue_system.get_queue_stats(location_id)
     return render_template('queue.html', location=location, stats=stats)
 
 @app.route('/queue/join', methods=['POST'])
 def join_queue():
-    location_id = request.form.get('location_id')
-    user_name = request.form.get('user_name')
-    phone = request.form.get('phone', '')
-    notes = request.form.get('notes', '')
+    form = request.form
+    location_id = form.get('location_id')
+    user_name = form.get('user_name')
+    phone = form.get('phone', '')
+    notes = form.get('notes', '')
     receipt_file = request.files.get('receipt')
     
     # Debug logging for receipt file
@@ -143,6 +201,7 @@ def join_queue():
     
     queue_id = queue_system.join_queue(location_id, user_name, phone, notes, receipt_file)
     if queue_id:
+        invalidate_location_views()
         flash(f'Successfully joined the queue! Your Queue ID is: {queue_id} - Keep this ID to check your status later', 'success')
         return redirect(url_for('queue_status', location_id=location_id, queue_id=queue_id))
     
@@ -160,6 +219,9 @@ def queue_status(location_id, queue_id):
 @app.route('/queue/leave/<location_id>/<queue_id>', methods=['POST'])
 def leave_queue(location_id, queue_id):
     if queue_system.leave_queue(location_id, queue_id):
+        # Everyone behind this entry moved up
+        cache.delete_memoized(cached_queue_position)
+        invalidate_location_views()
         flash('Successfully left the queue', 'success')
     else:
         flash('Error leaving queue', 'error')
@@ -176,10 +238,24 @@ def login():
         remember = 'remember' in request.form
         
         user = users.get(username)
-        if user and user.check_password(password):
+        password_ok = False
+        timed_out = False
+        if user:
+            future = HASH_EXECUTOR.submit(user.check_password, password)
+            try:
+                password_ok = future.result(timeout=HASH_TIMEOUT)
+            except FutureTimeoutError:
+                # The wait includes time queued behind other logins; drop the
+                # check if it hasn't started so it doesn't hold up later ones
+                future.cancel()
+                timed_out = True
+                app.logger.error("Password check timed out for user %s", username)
+        if password_ok:
             login_user(user, remember=remember)
             next_page = request.args.get('next')
             return redirect(next_page if next_page else url_for('admin_index'))
+        elif timed_out:
+            flash('Login is busy right now, please try again', 'error')
         else:
             flash('Invalid username or password', 'error')
     
@@ -193,9 +269,13 @@ def logout():
     return redirect(url_for('index'))
 
 def requires_super_admin(f):
+    """Require a logged-in super admin; replaces stacking @login_required"""
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        if not current_user.is_authenticated or not current_user.is_super_admin:
+        user = current_user
+        if not user.is_authenticated:
+            return login_manager.unauthorized()
+        if not user.is_super_admin:
             flash('You need super admin privileges to access this page', 'error')
             return redirect(url_for('admin_index'))
         return f(*args, **kwargs)
@@ -204,24 +284,36 @@ def requires_super_admin(f):
 @app.route('/queue/admin')
 @login_required
 def admin_index():
-    locations = queue_system.get_all_locations()
-    return render_template('queue_admin.html', locations=locations)
+    locations = cached_admin_locations()
+    return render_template('queue_admin.html', locations=locations, stats=queue_system.get_all_stats())
 
 @app.route('/super-admin')
-@login_required
 @requires_super_admin
 def super_admin():
-    admin_list = [user for user in users.values() if not user.is_super_admin]
-    return render_template('super_admin.html', admins=admin_list)
+    return render_template('super_admin.html', admins=admins)
+
+@app.route('/super-admin/sync-locations', methods=['POST'])
+@requires_super_admin
+def sync_locations():
+    """Write cached locations back to storage, skipping any changed there since"""
+    try:
+        total = len(queue_system.queues)
+        saved = queue_system.save_queues()
+        flash(f'Synced {saved} locations to storage', 'success')
+        if saved < total:
+            flash(f'Skipped {total - saved} locations that changed since they were loaded', 'warning')
+    except Exception as e:
+        flash(f'Error syncing locations: {str(e)}', 'error')
+    return redirect(url_for('super_admin'))
 
 @app.route('/super-admin/create-admin', methods=['GET', 'POST'])
-@login_required
 @requires_super_admin
 def create_admin():
     if request.method == 'POST':
-        username = request.form.get('username')
-        password = request.form.get('password')
-        location_limit = int(request.form.get('location_limit', 5))
+        form = request.form
+        username = form.get('username')
+        password = form.get('password')
+        location_limit = int(form.get('location_limit', 5))
         
         if not username or not password:
             flash('Username and password are required', 'error')
@@ -238,14 +330,13 @@ def create_admin():
             location_limit=location_limit,
             created_by=current_user.username
         )
-        users[username] = new_admin
+        add_user(new_admin)
         flash('Admin created successfully', 'success')
         return redirect(url_for('super_admin'))
     
     return render_template('create_admin.html')
 
 @app.route('/super-admin/edit-admin/<admin_id>', methods=['GET', 'POST'])
-@login_required
 @requires_super_admin
 def edit_admin(admin_id):
     admin = users.get(admin_id)
@@ -254,12 +345,13 @@ def edit_admin(admin_id):
         return redirect(url_for('super_admin'))
     
     if request.method == 'POST':
-        location_limit = int(request.form.get('location_limit', 5))
-        new_password = request.form.get('new_password')
+        form = request.form
+        location_limit = int(form.get('location_limit', 5))
+        new_password = form.get('new_password')
         
         admin.location_limit = location_limit
         if new_password:
-            admin.password_hash = generate_password_hash(new_password)
+            admin.set_password(new_password)
         
         flash('Admin updated successfully', 'success')
         return redirect(url_for('super_admin'))
@@ -275,9 +367,10 @@ def admin_create_location():
             flash('You have reached your location creation limit', 'error')
             return redirect(url_for('admin_index'))
             
-        name = request.form.get('name')
-        description = request.form.get('description', '')
-        capacity = int(request.form.get('capacity', 0))
+        form = request.form
+        name = form.get('name')
+        description = form.get('description', '')
+        capacity = int(form.get('capacity', 0))
         
         if not name:
             flash('Name is required', 'error')
@@ -287,6 +380,7 @@ def admin_create_location():
             # Get base URL for QR code
             base_url = request.url_root.rstrip('/')
             location_id = queue_system.create_location(name, description, capacity, base_url, created_by=current_user.username)
+            invalidate_location_views()
             # Increment the location count for the user
             current_user.increment_location_count()
             
@@ -315,7 +409,11 @@ def serve_qr(filename):
         if filename.startswith('qrcodes/'):
             filename = filename[8:]  # Remove 'qrcodes/' prefix
         url = queue_system.s3.get_file_url(f"qrcodes/{filename}")
-        return redirect(url)
+        response = redirect(url)
+        # Let the browser reuse the redirect while the signed URL is still valid
+        response.cache_control.private = True
+        response.cache_control.max_age = QR_REDIRECT_MAX_AGE
+        return response
     except Exception as e:
         return str(e), 500
 
@@ -330,11 +428,7 @@ def view_receipt(location_id, queue_id):
         return redirect(url_for('admin_index'))
     
     # Find the queue entry
-    queue_entry = None
-    for entry in location.get('current_queue', []):
-        if entry.get('id') == queue_id:
-            queue_entry = entry
-            break
+    queue_entry = queue_system.get_queue_entry(location, queue_id)
     
     if not queue_entry:
         flash('Queue entry not found', 'error')
@@ -374,26 +468,20 @@ def view_receipt(location_id, queue_id):
 @login_required
 def serve_receipt(filename):
     """Serve receipt files from local storage"""
-    import os
-    from flask import send_from_directory
-    
-    receipts_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'receipts')
-    
-    if not os.path.exists(os.path.join(receipts_dir, filename)):
+    # send_from_directory already stats the file, so let it report a miss
+    try:
+        return send_from_directory(RECEIPTS_DIR, filename)
+    except NotFound:
         return "Receipt not found", 404
-        
-    return send_from_directory(receipts_dir, filename)
 
 @app.route('/queue/admin/locations/<location_id>')
 def admin_manage_location(location_id):
-    location = queue_system.get_location(location_id)
+    # Queue and stats are derived from the same location read
+    location, queue, stats = queue_system.get_location_bundle(location_id)
     if not location:
         flash('Location not found', 'error')
         return redirect(url_for('admin_index'))
     
-    queue = queue_system.get_queue_list(location_id)
-    stats = queue_system.get_queue_stats(location_id)
-    
     # Update QR paths to use the new route
     if location.get('join_qr_path'):
         location['join_qr_path'] = os.path.basename(location['join_qr_path'])
@@ -409,6 +497,8 @@ def admin_manage_location(location_id):
 def admin_serve_next(location_id):
     served = queue_system.serve_next(location_id)
     if served:
+        cache.delete_memoized(cached_queue_position)
+        invalidate_location_views()
         flash(f'Served {served["user_name"]}', 'success')
     else:
         flash('No one in queue', 'info')
@@ -418,18 +508,40 @@ def admin_serve_next(location_id):
 def admin_delete_location(location_id):
     """Delete a location"""
     if queue_system.delete_location(location_id):
+        invalidate_location_views()
         flash('Location deleted successfully', 'success')
     else:
         flash('Failed to delete location', 'error')
     return redirect(url_for('admin_index'))
 
 # API endpoints
+def _json_default(obj):
+    # DynamoDB returns numbers as Decimal
+    if isinstance(obj, Decimal):
+        return int(obj) if obj == obj.to_integral_value() else float(obj)
+    raise TypeError
+
+def fast_jsonify(obj):
+    """jsonify() replacement serializing with orjson"""
+    return app.response_class(orjson.dumps(obj, default=_json_default), mimetype='application/json')
+
+@cache.memoize(timeout=STATUS_CACHE_TIMEOUT)
+def cached_queue_position(location_id, queue_id):
+    """Queue position lookup shared by clients polling the status API"""
+    return queue_system.get_queue_position(location_id, queue_id)
+
 @app.route('/api/queue/status/<location_id>/<queue_id>')
 def api_queue_status(location_id, queue_id):
-    status = queue_system.get_queue_position(location_id, queue_id)
+    status = cached_queue_position(location_id, queue_id)
     if not status:
         return jsonify({'error': 'Queue entry not found'}), 404
-    return jsonify(status)
+    response = fast_jsonify(status)
+    # Status is per visitor, so only the browser may cache it
+    response.cache_control.private = True
+    response.cache_control.max_age = STATUS_CACHE_TIMEOUT
+    # Pollers sending a matching If-None-Match get an empty 304
+    response.set_etag(hashlib.blake2b(response.get_data(), digest_size=8).hexdigest())
+    return response.make_conditional(request)
 
 # Vercel requires the app variable to be exposed
 if __name__ == '__main__':
@@ -1,6 +1,17 @@
+import hashlib
+import hmac
+import threading
+from cachetools import TTLCache
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin
 
+# Successful password checks, keyed by (user id, stored hash) and holding a
+# digest of the accepted password. Skips the deliberately slow KDF on repeat
+# logins; failed attempts are never cached and always pay the full cost.
+PASSWORD_CACHE_TTL = 300
+_verified_passwords = TTLCache(maxsize=1024, ttl=PASSWORD_CACHE_TTL)
+_verified_lock = threading.Lock()
+
 class User(UserMixin):
     def __init__(self, id, username, password_hash, is_super_admin=False, location_limit=5, created_by=None):
         self.id = id
@@ -17,22 +28,57 @@ class User(UserMixin):
         password_hash = generate_password_hash(password)
         return User(username, username, password_hash, is_super_admin, location_limit, created_by)
     
+    def set_password(self, password):
+        """Replace the user's password"""
+        self.password_hash = generate_password_hash(password)
+        with _verified_lock:
+            for key in [k for k in _verified_passwords if k[0] == self.id]:
+                del _verified_passwords[key]
+    
     def check_password(self, password):
         """Check if the provided password matches"""
-        return check_password_hash(self.password_hash, password)
+        if not password:
+            return False
+        key = (self.id, self.password_hash)
+        digest = hashlib.sha256(password.encode('utf-8')).digest()
+        with _verified_lock:
+            cached = _verified_passwords.get(key)
+        if cached is not None and hmac.compare_digest(cached, digest):
+            return True
+        
+        if not check_password_hash(self.password_hash, password):
+            return False
+        with _verified_lock:
+            _verified_passwords[key] = digest
+        return True
     
     def can_create_location(self):
         """Check if the user can create more locations"""
-        return self.is_super_admin or self.created_locations < self.location_limit
+        # location_limit is None for unlimited users
+        return self.is_super_admin or (self.location_limit is not None and self.created_locations < self.location_limit)
     
     def increment_location_count(self):
         """Increment the count of created locations"""
         if not self.is_super_admin:
             self.created_locations += 1
 
+# Precomputed hashes of the bootstrap passwords ("superadmin" / "admin"),
+# so importing this module does no KDF work on cold start
+SUPERADMIN_PASSWORD_HASH = "pbkdf2:sha256:260000$ZPyTNtaeBsLjYxcL$ba19efa7513b159d46e40220678dfad781d40fac8da6e03b56a034f94799bd04"
+ADMIN_PASSWORD_HASH = "pbkdf2:sha256:260000$9dFqNNXxInSqcvGk$4190e1b864b73dc84d398c99005482eb20f05ec1aaf2c6338ae8a9428fa2b9ed"
+
 # In-memory user storage for simplicity
 # In production, use a proper database
 users = {
-    "superadmin": User("superadmin", "superadmin", generate_password_hash("superadmin"), is_super_admin=True, location_limit=float('inf')),
-    "admin": User("admin", "admin", generate_password_hash("admin"), is_super_admin=False, location_limit=5)
+    "superadmin": User("superadmin", "superadmin", SUPERADMIN_PASSWORD_HASH, is_super_admin=True, location_limit=None),
+    "admin": User("admin", "admin", ADMIN_PASSWORD_HASH, is_super_admin=False, location_limit=5)
 }
+
+# Non-super admins, kept in step with users so listing them needs no scan
+admins = [user for user in users.values() if not user.is_super_admin]
+
+def add_user(user):
+    """Register a user and keep the admin list current"""
+    users[user.id] = user
+    if not user.is_super_admin:
+        admins.append(user)
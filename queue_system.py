@@ -1,19 +1,123 @@
-import json
+import base64
+import io
 import os
+import threading
+import time
 import uuid
+from functools import lru_cache
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import boto3
+import msgspec
+import orjson
 import qrcode
+from PIL import Image
 from datetime import datetime
+from decimal import Decimal
 from typing import List, Dict, Optional
 from api.s3_storage import S3Storage
 from api.dynamodb_storage import DynamoDBQueueStorage
+from cachetools import LRUCache
 import logging
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+logger = logging.getLogger(__name__)
+
+# QR codes never change once generated, so let browsers keep them for a day
+QR_UPLOAD_ARGS = {'ContentType': 'image/png', 'CacheControl': 'max-age=86400'}
+
+def _png_data_uri(png: bytes) -> str:
+    """Return PNG bytes as a base64 data URI"""
+    return 'data:image/png;base64,' + base64.b64encode(png).decode('ascii')
+
+# Pixels per QR module and quiet-zone width in modules
+QR_BOX_SIZE = 10
+QR_BORDER = 4
+
+# Uploads the join and status QR codes side by side
+_qr_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix='qr-upload')
+
+# The same URL always renders the same QR code, so keep recent renders around
+@lru_cache(maxsize=1024)
+def _render_qr_png(url: str) -> bytes:
+    """Render a QR code for url as PNG bytes"""
+    qr = qrcode.QRCode(
+        version=1,
+        error_correction=qrcode.constants.ERROR_CORRECT_L,
+        border=QR_BORDER,
+    )
+    qr.add_data(url)
+    qr.make(fit=True)
+    # Paint one pixel per module and scale up, rather than letting qrcode
+    # draw a rectangle per module
+    matrix = qr.get_matrix()
+    size = len(matrix)
+    image = Image.new('1', (size, size))
+    image.putdata([0 if module else 255 for row in matrix for module in row])
+    image = image.resize((size * QR_BOX_SIZE, size * QR_BOX_SIZE), Image.NEAREST)
+    buf = io.BytesIO()
+    # Optimizing these tiny images costs more than it saves
+    image.save(buf, format='PNG', optimize=False)
+    return buf.getvalue()
+
+_QUEUE_ENCODER = msgspec.msgpack.Encoder()
+_QUEUE_DECODER = msgspec.msgpack.Decoder()
+
+def _plain_numbers(obj):
+    """Copy of obj with DynamoDB's Decimals as int, or float when fractional"""
+    # msgspec encodes Decimal natively (as a string, or a float with
+    # decimal_format='number') and never hands it to an enc_hook
+    if isinstance(obj, Decimal):
+        return int(obj) if obj == obj.to_integral_value() else float(obj)
+    if isinstance(obj, dict):
+        return {k: _plain_numbers(v) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [_plain_numbers(v) for v in obj]
+    return obj
+
+def _read_queue_file(path: str) -> Dict:
+    """Parse the local msgpack queue file"""
+    with open(path, 'rb') as f:
+        return _QUEUE_DECODER.decode(f.read())
+
+def _write_queue_file(path: str, queues: Dict) -> None:
+    """Write the local msgpack queue file"""
+    with open(path, 'wb') as f:
+        f.write(_QUEUE_ENCODER.encode(_plain_numbers(queues)))
+
+def _read_legacy_queue_file(path: str) -> Dict:
+    """Parse a queue file written in the old JSON format"""
+    with open(path, 'rb') as f:
+        return orjson.loads(f.read())
+
+# Receipt types S3 may serve inline; anything else is stored as an opaque
+# download so an uploaded HTML page can't run when an admin opens it
+RECEIPT_CONTENT_TYPES = ('image/', 'application/pdf')
+
+def _receipt_content_type(receipt_file) -> str:
+    content_type = (getattr(receipt_file, 'mimetype', None) or '').lower()
+    if content_type.startswith(RECEIPT_CONTENT_TYPES) and content_type != 'image/svg+xml':
+        return content_type
+    return 'application/octet-stream'
+
+# Simple wait estimate; could be made more sophisticated based on historical data
+WAIT_MINUTES_PER_PERSON = 5
+
+# Seconds a full DynamoDB listing stays authoritative for get_all_locations
+ALL_LOCATIONS_TTL = 30
+
+# Queue IDs start with this many characters of their location ID
+QUEUE_ID_PREFIX_LENGTH = 8
+
+# Conditional DynamoDB writes re-read and retry this often when another
+# instance changed the location in between
+MAX_WRITE_ATTEMPTS = 5
 
 class QueueSystem:
-    def __init__(self, data_file='queue_data.json', s3_bucket=None, s3_region=None, s3_key=None, aws_access_key_id=None, aws_secret_access_key=None, dynamodb_table=None):
+    def __init__(self, data_file='queue_data.msgpack', s3_bucket=None, s3_region=None, s3_key=None, aws_access_key_id=None, aws_secret_access_key=None, dynamodb_table=None, dax_endpoint=None):
         self.data_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), data_file)
+        # Queue files from before the msgpack switch are read once and rewritten
+        self.legacy_data_file = os.path.splitext(self.data_file)[0] + '.json'
         self.s3_key = s3_key or data_file
         self.s3 = None
         self.dynamodb = None
@@ -33,180 +137,210 @@ class QueueSystem:
         if dynamodb_table:
             self.dynamodb = DynamoDBQueueStorage(
                 table_name=dynamodb_table,
-                session=self.aws_session
+                session=self.aws_session,
+                dax_endpoint=dax_endpoint
             )
         self.queues = {}
+        # When self.queues last mirrored a full DynamoDB listing
+        self._all_locations_at = 0.0
+        # Queue ID prefix -> location ID, kept in step with self.queues
+        self._location_prefixes = {}
+        # location_id -> (queue list, length indexed, {entry id: entry}) for O(1) entry lookups
+        self._entry_index = LRUCache(maxsize=1024)
+        self._entry_index_lock = threading.Lock()
+        # location_id -> (queue list, length seen, deque of waiting entries in position order)
+        self._waiting_index = LRUCache(maxsize=1024)
+        self._waiting_index_lock = threading.Lock()
         self.load_queues()
+        self._rebuild_location_prefixes()
 
     def load_queues(self):
-        """Load queue data from DynamoDB if available, else from JSON file"""
+        """Load queue data from DynamoDB if available, else from the local file"""
         try:
             if self.dynamodb:
-                logging.info("Loading locations from DynamoDB...")
+                logger.info("Loading locations from DynamoDB...")
                 locations = self.dynamodb.list_locations()
                 self.queues = {loc['location_id']: loc for loc in locations}
-                logging.info(f"Loaded {len(self.queues)} locations from DynamoDB")
+                self._all_locations_at = time.monotonic()
+                logger.info("Loaded %d locations from DynamoDB", len(self.queues))
+                self._backfill_queue_counters()
                 return
         except Exception as e:
-            logging.error(f"Error loading from DynamoDB: {str(e)}")
-            logging.info("Falling back to local file...")
+            logger.error("Error loading from DynamoDB: %s", e)
+            logger.info("Falling back to local file...")
             
         # Fallback to local file
         if os.path.exists(self.data_file):
             try:
-                with open(self.data_file, 'r', encoding='utf-8') as f:
-                    self.queues = json.load(f)
-                logging.info(f"Loaded {len(self.queues)} locations from local file")
-            except (json.JSONDecodeError, FileNotFoundError) as e:
-                logging.error(f"Error loading from local file: {str(e)}")
+                self.queues = _read_queue_file(self.data_file)
+                logger.info("Loaded %d locations from local file", len(self.queues))
+            except (msgspec.DecodeError, FileNotFoundError) as e:
+                logger.error("Error loading from local file: %s", e)
+                self.queues = {}
+        elif os.path.exists(self.legacy_data_file):
+            try:
+                self.queues = _read_legacy_queue_file(self.legacy_data_file)
+                logger.info("Loaded %d locations from legacy JSON file", len(self.queues))
+            except (orjson.JSONDecodeError, FileNotFoundError) as e:
+                logger.error("Error loading from legacy JSON file: %s", e)
                 self.queues = {}
     
-    def save_queues(self):
-        """Save queue data to DynamoDB if available, else to JSON file"""
+    def _backfill_queue_counters(self):
+        """Store counters on DynamoDB items written before they existed"""
+        for location in self.queues.values():
+            if 'active_waiting' in location and 'active_served' in location:
+                continue
+            self._refresh_queue_counters(location)
+            try:
+                # updated_at is left alone so the write only fails if the item changed
+                self.dynamodb.put_location(location, location['updated_at'])
+            except Exception as e:
+                logger.error("Error backfilling counters for location %s: %s", location['location_id'], e)
+
+    def save_queues(self) -> int:
+        """Save queue data to DynamoDB if available, else to the local file
+
+        Returns the number of locations saved. In DynamoDB every location
+        that changed there since it was loaded is left untouched.
+        """
         try:
             if self.dynamodb:
-                logging.info("Saving locations to DynamoDB...")
-                for location_id, location in self.queues.items():
-                    try:
-                        self.dynamodb.put_location(location)
-                        logging.debug(f"Successfully saved location {location_id}")
-                    except Exception as e:
-                        logging.error(f"Error saving location {location_id} to DynamoDB: {str(e)}")
-                        # Try to save to local file as backup
-                        with open(self.data_file, 'w', encoding='utf-8') as f:
-                            json.dump(self.queues, f, indent=2, ensure_ascii=False)
-                        logging.info("Saved to local file as backup")
-                        raise  # Re-raise the exception after backup
-                logging.info("Successfully saved all locations to DynamoDB")
+                logger.info("Saving locations to DynamoDB...")
+                # Backfill the counters on items written before they existed
+                for location in self.queues.values():
+                    self._refresh_queue_counters(location)
+                try:
+                    saved, skipped = self.dynamodb.put_locations_if_unchanged(self.queues.values())
+                except Exception as e:
+                    logger.error("Error saving locations to DynamoDB: %s", e)
+                    # Try to save to local file as backup
+                    _write_queue_file(self.data_file, self.queues)
+                    logger.info("Saved to local file as backup")
+                    raise  # Re-raise the exception after backup
+                logger.info("Successfully saved %d locations to DynamoDB, skipped %d changed elsewhere", saved, skipped)
+                return saved
             else:
-                logging.info("Saving to local file...")
-                with open(self.data_file, 'w', encoding='utf-8') as f:
-                    json.dump(self.queues, f, indent=2, ensure_ascii=False)
-                logging.info("Successfully saved to local file")
+                logger.info("Saving to local file...")
+                _write_queue_file(self.data_file, self.queues)
+                logger.info("Successfully saved to local file")
+                return len(self.queues)
         except Exception as e:
-            logging.error(f"Error in save_queues: {str(e)}")
+            logger.error("Error in save_queues: %s", e)
             raise
 
     def get_all_locations(self) -> List[Dict]:
         """Get all locations"""
         try:
             if self.dynamodb:
-                logging.info("Getting all locations from DynamoDB...")
+                # Local creates and deletes keep self.queues current in between
+                if time.monotonic() - self._all_locations_at < ALL_LOCATIONS_TTL:
+                    return list(self.queues.values())
+                logger.info("Getting all locations from DynamoDB...")
                 locations = self.dynamodb.list_locations()
                 # Update local cache
                 self.queues = {loc['location_id']: loc for loc in locations}
-                logging.info(f"Retrieved {len(locations)} locations from DynamoDB")
+                self._all_locations_at = time.monotonic()
+                self._rebuild_location_prefixes()
+                logger.info("Retrieved %d locations from DynamoDB", len(locations))
                 return locations
             
-            logging.info("Getting all locations from local cache...")
+            logger.info("Getting all locations from local cache...")
             return list(self.queues.values())
         except Exception as e:
-            logging.error(f"Error getting all locations: {str(e)}")
+            logger.error("Error getting all locations: %s", e)
             # Return what we have in local cache as fallback
             return list(self.queues.values())
 
-    def generate_qr_codes(self, location_id: str, base_url: str) -> tuple[Optional[str], Optional[str]]:
-        """Generate QR codes for a location and return the filenames"""
+    def get_location_counts(self) -> tuple[int, int]:
+        """Get the number of locations and how many of them have people waiting"""
         try:
-            # Generate queue join QR code
-            join_qr = qrcode.QRCode(
-                version=1,
-                error_correction=qrcode.constants.ERROR_CORRECT_L,
-                box_size=10,
-                border=4,
-            )
-            join_qr.add_data(f"{base_url}/queue/{location_id}")
-            join_qr.make(fit=True)
-            join_image = join_qr.make_image(fill_color="black", back_color="white")
-
-            # Generate status check QR code
-            status_qr = qrcode.QRCode(
-                version=1,
-                error_correction=qrcode.constants.ERROR_CORRECT_L,
-                box_size=10,
-                border=4,
-            )
-            status_qr.add_data(f"{base_url}/status_check/{location_id}")
-            status_qr.make(fit=True)
-            status_image = status_qr.make_image(fill_color="black", back_color="white")
-            
-            # Use temporary file in /tmp directory (writable in Vercel)
-            tmp_join_path = os.path.join('/tmp', f"{location_id}_join.png")
-            tmp_status_path = os.path.join('/tmp', f"{location_id}_status.png")
-            
-            # Save to temporary location
-            join_image.save(tmp_join_path)
-            status_image.save(tmp_status_path)
-            
-            logging.info(f"Generated QR codes temporarily at {tmp_join_path} and {tmp_status_path}")
+            if self.dynamodb:
+                return self.dynamodb.count_locations()
+        except Exception as e:
+            logger.error("Error counting locations: %s", e)
+        locations = list(self.queues.values())
+        return len(locations), sum(1 for loc in locations if self.waiting_count(loc))
 
-            # Upload to S3
+    def generate_qr_codes(self, location_id: str, base_url: str) -> Dict[str, str]:
+        """Generate QR codes for a location and return their filenames and inline data URIs"""
+        try:
+            join_png = _render_qr_png(f"{base_url}/queue/{location_id}")
+            status_png = _render_qr_png(f"{base_url}/status_check/{location_id}")
+
+            # The PNGs are immutable and small, so keep a copy to inline in pages
+            qr_fields = {
+                'join_qr_data_uri': _png_data_uri(join_png),
+                'status_qr_data_uri': _png_data_uri(status_png),
+            }
+
+            # Upload to S3 straight from memory, both codes at once
             if self.s3:
                 try:
                     join_s3_key = f"qrcodes/{location_id}_join.png"
                     status_s3_key = f"qrcodes/{location_id}_status.png"
-                    self.s3.upload_file(tmp_join_path, join_s3_key)
-                    self.s3.upload_file(tmp_status_path, status_s3_key)
-                    logging.info(f"Uploaded QR codes to S3: {join_s3_key}, {status_s3_key}")
+                    uploads = [
+                        _qr_pool.submit(self.s3.upload_file_obj, io.BytesIO(png), key, extra_args=QR_UPLOAD_ARGS)
+                        for png, key in ((join_png, join_s3_key), (status_png, status_s3_key))
+                    ]
+                    # Wait here, serverless runtimes may freeze once the response is sent
+                    for upload in uploads:
+                        upload.result()
+                    logger.info("Uploaded QR codes to S3: %s, %s", join_s3_key, status_s3_key)
                 except Exception as e:
-                    logging.error(f"Error uploading QR codes to S3: {str(e)}")
-                finally:
-                    # Clean up temporary files
-                    try:
-                        os.remove(tmp_join_path)
-                        os.remove(tmp_status_path)
-                    except Exception as e:
-                        logging.error(f"Error cleaning up temporary files: {str(e)}")
-
-            # Return just the filenames without the qrcodes/ prefix
-            return f"{location_id}_join.png", f"{location_id}_status.png"
+                    logger.error("Error uploading QR codes to S3: %s", e)
+
+            # Store just the filenames without the qrcodes/ prefix
+            qr_fields['join_qr_path'] = f"{location_id}_join.png"
+            qr_fields['status_qr_path'] = f"{location_id}_status.png"
+            return qr_fields
         except Exception as e:
-            logging.error(f"Error generating QR codes: {str(e)}")
-            return None, None
+            logger.error("Error generating QR codes: %s", e)
+            return {}
         except Exception as e:
-            logging.error(f"Error generating QR code: {str(e)}")
+            logger.error("Error generating QR code: %s", e)
             return None
 
     def create_location(self, name: str, description: str = "", capacity: int = 0, base_url: str = "", created_by: str = None) -> str:
         """Create a new location with queue"""
         try:
             location_id = str(uuid.uuid4())
+            now = datetime.now().isoformat()
             location = {
                 'location_id': location_id,
                 'name': name,
                 'description': description,
                 'capacity': capacity,
                 'current_queue': [],
+                'active_waiting': 0,
+                'active_served': 0,
                 'served_count': 0,
-                'created_at': datetime.now().isoformat(),
-                'updated_at': datetime.now().isoformat(),
+                'created_at': now,
+                'updated_at': now,
                 'created_by': created_by
             }
             
             # Generate QR codes
             if base_url:
-                join_qr_path, status_qr_path = self.generate_qr_codes(location_id, base_url)
-                if join_qr_path and status_qr_path:
-                    location['join_qr_path'] = join_qr_path
-                    location['status_qr_path'] = status_qr_path
+                location.update(self.generate_qr_codes(location_id, base_url))
             
             # Save to DynamoDB first if available
             if self.dynamodb:
                 self.dynamodb.put_location(location)
-                logging.info(f"Location saved to DynamoDB: {location_id}")
+                logger.info("Location saved to DynamoDB: %s", location_id)
             
             # Update local cache
             self.queues[location_id] = location
+            self._location_prefixes[location_id[:QUEUE_ID_PREFIX_LENGTH]] = location_id
             
             # Save to file if not using DynamoDB
             if not self.dynamodb:
                 self.save_queues()
             
-            logging.info(f"Created new location: {name} ({location_id})")
+            logger.info("Created new location: %s (%s)", name, location_id)
             return location_id
             
         except Exception as e:
-            logging.error(f"Error creating location: {str(e)}")
+            logger.error("Error creating location: %s", e)
             raise
 
     def get_location(self, location_id: str) -> Optional[Dict]:
@@ -220,29 +354,40 @@ class QueueSystem:
                 return location
             return self.queues.get(location_id)
         except Exception as e:
-            logging.error(f"Error getting location {location_id}: {str(e)}")
+            logger.error("Error getting location %s: %s", location_id, e)
             return self.queues.get(location_id)  # Fallback to local cache
 
+    def _get_location_for_update(self, location_id: str) -> Optional[Dict]:
+        """Get the latest copy of a location, bypassing read caches, before changing it"""
+        if self.dynamodb:
+            location = self.dynamodb.get_location(location_id, consistent=True)
+            if location:
+                # Update local cache
+                self.queues[location_id] = location
+            return location
+        return self.queues.get(location_id)
+
+    def _save_location(self, location: Dict, expected_updated_at: str) -> bool:
+        """Save a changed location; False if DynamoDB holds a newer copy than the one changed"""
+        if self.dynamodb:
+            return self.dynamodb.put_location(location, expected_updated_at)
+        self.save_queues()
+        return True
+
     def get_queue_list(self, location_id: str) -> List[Dict]:
         """Get list of people currently in queue"""
         try:
             location = self.get_location(location_id)
             if not location:
-                logging.warning(f"Location {location_id} not found")
+                logger.warning("Location %s not found", location_id)
                 return []
             
-            # Filter for only waiting entries and sort by position
-            queue = [
-                entry for entry in location.get('current_queue', [])
-                if entry.get('status') == 'waiting'
-            ]
-            queue.sort(key=lambda x: x.get('position', 0))
-            
-            logging.info(f"Retrieved {len(queue)} waiting entries for location {location_id}")
+            queue = self._waiting_queue(location)
+            logger.info("Retrieved %d waiting entries for location %s", len(queue), location_id)
             return queue
             
         except Exception as e:
-            logging.error(f"Error getting queue list for location {location_id}: {str(e)}")
+            logger.error("Error getting queue list for location %s: %s", location_id, e)
             return []
 
     def get_queue_stats(self, location_id: str) -> Dict:
@@ -250,68 +395,150 @@ class QueueSystem:
         try:
             location = self.get_location(location_id)
             if not location:
-                logging.warning(f"Location {location_id} not found")
-                return {
-                    'location_name': '',
-                    'waiting_count': 0,
-                    'served_count': 0,
-                    'total_served': 0,
-                    'capacity': 0,
-                    'estimated_wait': 0
-                }
-            
-            waiting_count = len([
-                e for e in location.get('current_queue', [])
-                if e.get('status') == 'waiting'
-            ])
-            served_count = len([
-                e for e in location.get('current_queue', [])
-                if e.get('status') == 'served'
-            ])
+                logger.warning("Location %s not found", location_id)
+                return self._empty_stats()
             
-            stats = {
-                'location_name': location.get('name', ''),
-                'waiting_count': waiting_count,
-                'served_count': served_count,
-                'total_served': location.get('served_count', 0),
-                'capacity': location.get('capacity', 0),
-                'estimated_wait': self._estimate_wait_time(waiting_count)
-            }
-            
-            logging.info(f"Retrieved stats for location {location_id}: {stats}")
+            stats = self._queue_stats(location)
+            logger.info("Retrieved stats for location %s: %s", location_id, stats)
             return stats
             
         except Exception as e:
-            logging.error(f"Error getting queue stats for location {location_id}: {str(e)}")
-            return {
-                'location_name': '',
-                'waiting_count': 0,
-                'served_count': 0,
-                'total_served': 0,
-                'capacity': 0,
-                'estimated_wait': 0
-            }
-    
-    def _estimate_wait_time(self, position: int) -> int:
-        """Estimate wait time in minutes based on position"""
-        # Simple estimation: 5 minutes per person
-        return position * 5
+            logger.error("Error getting queue stats for location %s: %s", location_id, e)
+            return self._empty_stats()
+
+    def get_location_bundle(self, location_id: str) -> tuple[Optional[Dict], List[Dict], Dict]:
+        """Get a location with its waiting queue and stats from a single read"""
+        location = self.get_location(location_id)
+        if not location:
+            logger.warning("Location %s not found", location_id)
+            return None, [], self._empty_stats()
+        try:
+            return location, self._waiting_queue(location), self._queue_stats(location)
+        except Exception as e:
+            logger.error("Error building queue bundle for location %s: %s", location_id, e)
+            return location, [], self._empty_stats()
+
+    def _waiting_queue(self, location: Dict) -> List[Dict]:
+        """Waiting entries of a location sorted by position"""
+        return list(self._waiting_entries(location))
+
+    def _waiting_entries(self, location: Dict) -> deque:
+        """Deque of waiting entries in position order, kept up to date across calls
+
+        Joins append with increasing positions, so entries added since the
+        last call are appended as they are; only a new queue list is sorted.
+        """
+        location_id = location.get('location_id')
+        current_queue = location.get('current_queue', [])
+        with self._waiting_index_lock:
+            cached = self._waiting_index.get(location_id)
+            if cached and cached[0] is current_queue and cached[1] <= len(current_queue):
+                waiting = cached[2]
+                waiting.extend(e for e in current_queue[cached[1]:] if e.get('status') == 'waiting')
+                # Skip entries whose status changed behind our back
+                while waiting and waiting[0].get('status') != 'waiting':
+                    waiting.popleft()
+            else:
+                waiting = deque(sorted(
+                    (e for e in current_queue if e.get('status') == 'waiting'),
+                    key=lambda x: x.get('position', 0)
+                ))
+            self._waiting_index[location_id] = (current_queue, len(current_queue), waiting)
+        return waiting
+
+    def _queue_stats(self, location: Dict) -> Dict:
+        """Queue statistics computed from a location document"""
+        waiting_count = self.waiting_count(location)
+        served_count = self.queue_served_count(location)
+        
+        return {
+            'location_name': location.get('name', ''),
+            'waiting_count': waiting_count,
+            'served_count': served_count,
+            'total_served': location.get('served_count', 0),
+            'capacity': location.get('capacity', 0),
+            'estimated_wait': waiting_count * WAIT_MINUTES_PER_PERSON
+        }
+
+    def get_all_stats(self) -> Dict[str, Dict]:
+        """Queue statistics for every cached location, read from the stored counters"""
+        return {
+            location_id: self._queue_stats(location)
+            for location_id, location in list(self.queues.items())
+        }
+
+    @staticmethod
+    def _empty_stats() -> Dict:
+        return {
+            'location_name': '',
+            'waiting_count': 0,
+            'served_count': 0,
+            'total_served': 0,
+            'capacity': 0,
+            'estimated_wait': 0
+        }
     
+    @staticmethod
+    def _refresh_queue_counters(location: Dict):
+        """Recount waiting and served entries and store them on the location itself"""
+        waiting = served = 0
+        for e in location.get('current_queue', []):
+            status = e.get('status')
+            if status == 'waiting':
+                waiting += 1
+            elif status == 'served':
+                served += 1
+        location['active_waiting'] = waiting
+        location['active_served'] = served
+
+    @staticmethod
+    def waiting_count(location: Dict) -> int:
+        """Number of waiting entries, without walking the queue when the counter is present"""
+        if 'active_waiting' in location:
+            return int(location['active_waiting'])
+        return sum(1 for e in location.get('current_queue', []) if e.get('status') == 'waiting')
+
+    @staticmethod
+    def queue_served_count(location: Dict) -> int:
+        """Number of served entries still in the queue, using the counter when present"""
+        if 'active_served' in location:
+            return int(location['active_served'])
+        return sum(1 for e in location.get('current_queue', []) if e.get('status') == 'served')
+
+    def get_queue_entry(self, location: Dict, queue_id: str) -> Optional[Dict]:
+        """Find a queue entry by ID, reusing the index while the queue list is the same"""
+        location_id = location.get('location_id')
+        current_queue = location.get('current_queue', [])
+        with self._entry_index_lock:
+            cached = self._entry_index.get(location_id)
+            if cached and cached[0] is current_queue and cached[1] <= len(current_queue):
+                by_id = cached[2]
+                # Index only the entries appended since the last lookup
+                for e in current_queue[cached[1]:]:
+                    by_id[e.get('id')] = e
+            else:
+                by_id = {e.get('id'): e for e in current_queue}
+            self._entry_index[location_id] = (current_queue, len(current_queue), by_id)
+        return by_id.get(queue_id)
+
     def _save_receipt_file(self, receipt_file, queue_id: str) -> Optional[str]:
-        """Save receipt file to S3 or local storage"""
+        """Save receipt file to S3, or to local storage when S3 isn't configured
+
+        Raises if the upload itself fails.
+        """
         try:
             import os
             from werkzeug.utils import secure_filename
             
             # Check if file is valid
             if not receipt_file or not hasattr(receipt_file, 'filename') or not receipt_file.filename:
-                logging.warning("Invalid receipt file provided")
+                logger.warning("Invalid receipt file provided")
                 return None
             
             # Get file extension
             filename = secure_filename(receipt_file.filename)
             if not filename:
-                logging.warning("Invalid filename after securing")
+                logger.warning("Invalid filename after securing")
                 return None
                 
             file_ext = os.path.splitext(filename)[1].lower()
@@ -326,12 +553,17 @@ class QueueSystem:
                 # Upload to S3 (required for serverless deployment)
                 try:
                     receipt_path = f"receipts/{receipt_filename}"
-                    self.s3.upload_file_obj(receipt_file, receipt_path)
-                    logging.info(f"Uploaded receipt to S3: {receipt_path}")
+                    # Stream the underlying upload straight to S3, multipart for large files
+                    self.s3.upload_file_obj(
+                        getattr(receipt_file, 'stream', receipt_file),
+                        receipt_path,
+                        extra_args={'ContentType': _receipt_content_type(receipt_file)}
+                    )
+                    logger.info("Uploaded receipt to S3: %s", receipt_path)
                     return receipt_path
                 except Exception as e:
-                    logging.error(f"Failed to upload receipt to S3: {str(e)}")
-                    return None
+                    logger.error("Failed to upload receipt to S3: %s", e)
+                    raise
             
             # For local development only - won't work in serverless
             try:
@@ -340,106 +572,115 @@ class QueueSystem:
                 
                 local_path = os.path.join(receipts_dir, receipt_filename)
                 receipt_file.save(local_path)
-                logging.info(f"Saved receipt locally: {local_path}")
+                logger.info("Saved receipt locally: %s", local_path)
                 return f"receipts/{receipt_filename}"
             except Exception as e:
-                logging.error(f"Local storage failed (expected in serverless): {str(e)}")
+                logger.error("Local storage failed (expected in serverless): %s", e)
                 return None
             
         except Exception as e:
-            logging.error(f"Error saving receipt file: {str(e)}")
-            return None
+            logger.error("Error saving receipt file: %s", e)
+            raise
     
     def serve_next(self, location_id: str) -> Optional[Dict]:
         """Serve the next person in queue"""
         try:
-            location = self.get_location(location_id)
-            if not location:
-                logging.warning(f"Location {location_id} not found")
-                return None
-            
-            # Get the waiting queue sorted by position
-            waiting_queue = [
-                e for e in location.get('current_queue', [])
-                if e.get('status') == 'waiting'
-            ]
-            waiting_queue.sort(key=lambda x: x.get('position', 0))
-            
-            if not waiting_queue:
-                logging.info(f"No one waiting in queue at location {location_id}")
-                return None
-            
-            # Get the first person in queue
-            next_person = waiting_queue[0]
-            next_person['status'] = 'served'
-            next_person['served_at'] = datetime.now().isoformat()
-            
-            # Update location
-            location['served_count'] = location.get('served_count', 0) + 1
-            location['updated_at'] = datetime.now().isoformat()
-            
-            # Save changes
-            if self.dynamodb:
-                self.dynamodb.put_location(location)
-            else:
-                self.save_queues()
-            
-            logging.info(f"Served {next_person.get('user_name')} at location {location_id}")
-            return next_person
-            
+            for _ in range(MAX_WRITE_ATTEMPTS):
+                location = self._get_location_for_update(location_id)
+                if not location:
+                    logger.warning("Location %s not found", location_id)
+                    return None
+
+                # Waiting entries in position order
+                waiting_queue = self._waiting_entries(location)
+
+                if not waiting_queue:
+                    logger.info("No one waiting in queue at location %s", location_id)
+                    return None
+
+                # Get the first person in queue
+                served_in_queue = self.queue_served_count(location)
+                next_person = waiting_queue.popleft()
+                next_person['status'] = 'served'
+                now = datetime.now().isoformat()
+                next_person['served_at'] = now
+
+                # Update location; the counters move by one instead of being recounted
+                previous_updated_at = location['updated_at']
+                location['served_count'] = location.get('served_count', 0) + 1
+                location['updated_at'] = now
+                location['active_waiting'] = len(waiting_queue)
+                location['active_served'] = served_in_queue + 1
+
+                # Save changes unless someone else changed the location meanwhile
+                if self._save_location(location, previous_updated_at):
+                    logger.info("Served %s at location %s", next_person.get('user_name'), location_id)
+                    return next_person
+                logger.info("Location %s changed while serving, retrying", location_id)
+
+            logger.error("Gave up serving at location %s after %d conflicting writes", location_id, MAX_WRITE_ATTEMPTS)
+            return None
+
         except Exception as e:
-            logging.error(f"Error serving next person at location {location_id}: {str(e)}")
+            logger.error("Error serving next person at location %s: %s", location_id, e)
             return None
 
     def delete_location(self, location_id: str) -> bool:
         """Delete a location"""
         try:
             if not location_id in self.queues:
-                logging.warning(f"Location {location_id} not found")
+                logger.warning("Location %s not found", location_id)
                 return False
 
             # Delete from DynamoDB if available
             if self.dynamodb:
                 try:
                     self.dynamodb.delete_location(location_id)
-                    logging.info(f"Deleted location {location_id} from DynamoDB")
+                    logger.info("Deleted location %s from DynamoDB", location_id)
                 except Exception as e:
-                    logging.error(f"Error deleting location {location_id} from DynamoDB: {str(e)}")
+                    logger.error("Error deleting location %s from DynamoDB: %s", location_id, e)
                     return False
 
             # Delete from local cache
             del self.queues[location_id]
+            self._location_prefixes.pop(location_id[:QUEUE_ID_PREFIX_LENGTH], None)
             
             # Save to file if not using DynamoDB
             if not self.dynamodb:
                 self.save_queues()
             
-            logging.info(f"Successfully deleted location {location_id}")
+            logger.info("Successfully deleted location %s", location_id)
             return True
             
         except Exception as e:
-            logging.error(f"Error deleting location {location_id}: {str(e)}")
+            logger.error("Error deleting location %s: %s", location_id, e)
             return False
 
     def join_queue(self, location_id: str, user_name: str, phone: str = "", notes: str = "", receipt_file=None) -> Optional[str]:
         """Join a queue at a location"""
         try:
-            location = self.get_location(location_id)
+            # Positions and counters are computed from the latest copy
+            location = self._get_location_for_update(location_id)
             if not location:
-                logging.warning(f"Location {location_id} not found when trying to join queue")
+                logger.warning("Location %s not found when trying to join queue", location_id)
                 return None
 
             # Create queue entry with combined ID (location_id + unique ID)
             unique_id = str(uuid.uuid4())[:8]  # First 8 chars of UUID for shorter ID
-            queue_id = f"{location_id[:8]}-{unique_id}"  # Format: LOCXXXXX-UNIQXXXX
-            position = len([e for e in location.get('current_queue', []) if e.get('status') == 'waiting']) + 1
+            queue_id = f"{location_id[:QUEUE_ID_PREFIX_LENGTH]}-{unique_id}"  # Format: LOCXXXXX-UNIQXXXX
+            position = self.waiting_count(location) + 1
             
             # Handle receipt file upload
             receipt_path = None
             if receipt_file and hasattr(receipt_file, 'filename') and receipt_file.filename and receipt_file.filename.strip():
-                receipt_path = self._save_receipt_file(receipt_file, queue_id)
-                logging.info(f"Receipt upload attempted for queue_id {queue_id}, result: {receipt_path}")
+                try:
+                    receipt_path = self._save_receipt_file(receipt_file, queue_id)
+                except Exception as e:
+                    # The person still joins; the receipt can be shown in person
+                    logger.error("Receipt upload failed for queue_id %s: %s", queue_id, e)
+                logger.info("Receipt upload attempted for queue_id %s, result: %s", queue_id, receipt_path)
             
+            now = datetime.now().isoformat()
             queue_entry = {
                 'id': queue_id,
                 'user_name': user_name,
@@ -447,7 +688,7 @@ class QueueSystem:
                 'notes': notes,
                 'receipt_path': receipt_path,
                 'position': position,
-                'joined_at': datetime.now().isoformat(),
+                'joined_at': now,
                 'status': 'waiting'  # waiting, served, left
             }
 
@@ -457,55 +698,65 @@ class QueueSystem:
 
             # Add to queue
             location['current_queue'].append(queue_entry)
-            location['updated_at'] = datetime.now().isoformat()
+            location['updated_at'] = now
+            location['active_waiting'] = position
 
-            # Save changes
+            # Save changes; DynamoDB appends in place so concurrent joins don't overwrite each other
             if self.dynamodb:
-                self.dynamodb.put_location(location)
+                self.dynamodb.append_queue_entry(location_id, queue_entry, location['updated_at'], location,
+                                                 waiting_before=position - 1)
             else:
                 self.save_queues()
 
-            logging.info(f"User {user_name} joined queue at location {location_id} with queue_id {queue_id}")
+            logger.info("User %s joined queue at location %s with queue_id %s", user_name, location_id, queue_id)
             return queue_id
 
         except Exception as e:
-            logging.error(f"Error joining queue at location {location_id}: {str(e)}")
+            logger.error("Error joining queue at location %s: %s", location_id, e)
             return None
 
     def leave_queue(self, location_id: str, queue_id: str) -> bool:
         """Remove a person from queue"""
         try:
-            location = self.get_location(location_id)
-            if not location:
-                logging.warning(f"Location {location_id} not found")
-                return False
+            for _ in range(MAX_WRITE_ATTEMPTS):
+                location = self._get_location_for_update(location_id)
+                if not location:
+                    logger.warning("Location %s not found", location_id)
+                    return False
+
+                # Find and update the queue entry
+                entry = self.get_queue_entry(location, queue_id)
+                if not entry or entry.get('status') != 'waiting':
+                    logger.warning("Queue entry %s not found or not waiting at location %s", queue_id, location_id)
+                    return False
 
-            # Find and update the queue entry
-            for entry in location.get('current_queue', []):
-                if entry.get('id') == queue_id and entry.get('status') == 'waiting':
-                    entry['status'] = 'left'
-                    entry['left_at'] = datetime.now().isoformat()
-                    location['updated_at'] = datetime.now().isoformat()
-
-                    # Recalculate positions for remaining people
-                    waiting_entries = [e for e in location['current_queue'] if e.get('status') == 'waiting']
-                    for pos, e in enumerate(sorted(waiting_entries, key=lambda x: x.get('position', 0)), 1):
-                        e['position'] = pos
-
-                    # Save changes
-                    if self.dynamodb:
-                        self.dynamodb.put_location(location)
-                    else:
-                        self.save_queues()
-
-                    logging.info(f"User left queue at location {location_id} with queue_id {queue_id}")
+                waiting_entries = self._waiting_entries(location)
+                entry['status'] = 'left'
+                now = datetime.now().isoformat()
+                entry['left_at'] = now
+                previous_updated_at = location['updated_at']
+                location['updated_at'] = now
+                try:
+                    waiting_entries.remove(entry)
+                except ValueError:
+                    pass
+
+                # Recalculate positions for remaining people
+                for pos, e in enumerate(waiting_entries, 1):
+                    e['position'] = pos
+                location['active_waiting'] = len(waiting_entries)
+
+                # Save changes unless someone else changed the location meanwhile
+                if self._save_location(location, previous_updated_at):
+                    logger.info("User left queue at location %s with queue_id %s", location_id, queue_id)
                     return True
+                logger.info("Location %s changed while leaving, retrying", location_id)
 
-            logging.warning(f"Queue entry {queue_id} not found or not waiting at location {location_id}")
+            logger.error("Gave up leaving queue at location %s after %d conflicting writes", location_id, MAX_WRITE_ATTEMPTS)
             return False
 
         except Exception as e:
-            logging.error(f"Error leaving queue at location {location_id}: {str(e)}")
+            logger.error("Error leaving queue at location %s: %s", location_id, e)
             return False
 
     def get_queue_position(self, location_id: str, queue_id: str) -> Optional[Dict]:
@@ -513,47 +764,46 @@ class QueueSystem:
         try:
             location = self.get_location(location_id)
             if not location:
-                logging.warning(f"Location {location_id} not found")
+                logger.warning("Location %s not found", location_id)
                 return None
 
             # Find the queue entry
-            for entry in location.get('current_queue', []):
-                if entry.get('id') == queue_id and entry.get('status') == 'waiting':
-                    # Count total waiting
-                    total_waiting = len([e for e in location['current_queue'] if e.get('status') == 'waiting'])
-                    
-                    return {
-                        'position': entry.get('position', 0),
-                        'total_in_queue': total_waiting,
-                        'user_name': entry.get('user_name', ''),
-                        'joined_at': entry.get('joined_at', ''),
-                        'estimated_wait': self._estimate_wait_time(entry.get('position', 0))
-                    }
-
-            logging.warning(f"Queue entry {queue_id} not found or not waiting at location {location_id}")
+            entry = self.get_queue_entry(location, queue_id)
+            if entry and entry.get('status') == 'waiting':
+                total_waiting = self.waiting_count(location)
+                
+                return {
+                    'position': entry.get('position', 0),
+                    'total_in_queue': total_waiting,
+                    'user_name': entry.get('user_name', ''),
+                    'joined_at': entry.get('joined_at', ''),
+                    'estimated_wait': entry.get('position', 0) * WAIT_MINUTES_PER_PERSON
+                }
+
+            logger.warning("Queue entry %s not found or not waiting at location %s", queue_id, location_id)
             return None
 
         except Exception as e:
-            logging.error(f"Error getting queue position for {queue_id} at location {location_id}: {str(e)}")
+            logger.error("Error getting queue position for %s at location %s: %s", queue_id, location_id, e)
             return None
 
-    def _estimate_wait_time(self, position: int) -> int:
-        """Estimate wait time in minutes based on position"""
-        # Assuming average of 5 minutes per person
-        # Could be made more sophisticated based on historical data
-        average_time_per_person = 5
-        return position * average_time_per_person
+    def _rebuild_location_prefixes(self):
+        """Rebuild the queue ID prefix table from the local cache"""
+        self._location_prefixes = {
+            loc_id[:QUEUE_ID_PREFIX_LENGTH]: loc_id for loc_id in self.queues
+        }
 
     def get_location_from_queue_id(self, queue_id: str) -> Optional[str]:
         """Extract location ID from a queue ID"""
         try:
             # Queue ID format is LOCXXXXX-UNIQXXXX
-            location_part = queue_id.split('-')[0]
-            # Search through locations to find matching prefix
-            for location_id in self.queues:
-                if location_id.startswith(location_part):
-                    return location_id
-            return None
+            location_part = queue_id.partition('-')[0]
+            location_id = self._location_prefixes.get(location_part)
+            if location_id is None and location_part:
+                # Locations cached by single reads are not indexed yet
+                self._rebuild_location_prefixes()
+                location_id = self._location_prefixes.get(location_part)
+            return location_id
         except Exception as e:
-            logging.error(f"Error extracting location from queue ID {queue_id}: {str(e)}")
+            logger.error("Error extracting location from queue ID %s: %s", queue_id, e)
             return None
@@ -92,3 +92,25 @@ def test_leave_queue(client):
                          follow_redirects=True)
     assert response.status_code == 200
     assert b'Successfully left the queue' in response.data
+
+def test_queue_status_etag(client, monkeypatch):
+    """Test status polls with a matching ETag get an empty 304"""
+    import app as app_module
+    status = {'position': 2, 'total_in_queue': 3, 'user_name': 'Poller', 'joined_at': '', 'estimated_wait': 10}
+    monkeypatch.setattr(app_module, 'cached_queue_position', lambda location_id, queue_id: status)
+
+    response = client.get('/api/queue/status/loc-1/loc-1-abcd')
+    assert response.status_code == 200
+    assert response.json['position'] == 2
+    etag = response.headers['ETag']
+    assert 'private' in response.headers['Cache-Control']
+
+    response = client.get('/api/queue/status/loc-1/loc-1-abcd', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.data == b''
+
+    # A changed position gets a fresh body
+    status['position'] = 1
+    response = client.get('/api/queue/status/loc-1/loc-1-abcd', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
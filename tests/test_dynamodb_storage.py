@@ -0,0 +1,124 @@
+import pytest
+from boto3.dynamodb.types import TypeSerializer
+from botocore.stub import ANY, Stubber
+from api.dynamodb_storage import DynamoDBQueueStorage
+from queue_system import QueueSystem
+
+TABLE = 'locations'
+
+@pytest.fixture
+def storage(monkeypatch):
+    """DynamoDB storage with fake credentials; every call goes through a Stubber"""
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    return DynamoDBQueueStorage(TABLE)
+
+@pytest.fixture
+def client_stub(storage):
+    with Stubber(storage.client) as stub:
+        yield stub
+        stub.assert_no_pending_responses()
+
+@pytest.fixture
+def table_stub(storage):
+    with Stubber(storage.table.meta.client) as stub:
+        yield stub
+        stub.assert_no_pending_responses()
+
+def serialized(location):
+    serializer = TypeSerializer()
+    return {k: serializer.serialize(v) for k, v in location.items()}
+
+def append_params(base):
+    return {
+        'TableName': TABLE,
+        'Key': {'location_id': {'S': 'loc-1'}},
+        'UpdateExpression': ANY,
+        'ConditionExpression': 'attribute_exists(location_id)',
+        'ExpressionAttributeValues': {
+            ':empty': {'L': []},
+            ':entry': {'L': [{'M': {'id': {'S': 'loc-1-abcd'}}}]},
+            ':updated_at': {'S': '2024-01-01T00:00:00'},
+            ':base': {'N': str(base)},
+            ':one': {'N': '1'},
+        },
+    }
+
+def test_append_queue_entry(storage, client_stub):
+    """Test appending sends one update that seeds missing counters from the caller's count"""
+    client_stub.add_response('update_item', {}, append_params(base=3))
+    location = {'location_id': 'loc-1', 'current_queue': [{'id': 'loc-1-abcd'}]}
+    assert storage.append_queue_entry('loc-1', {'id': 'loc-1-abcd'}, '2024-01-01T00:00:00', location, waiting_before=3)
+    # The caller's copy replaces the cached item
+    assert storage.get_location('loc-1') is location
+
+def test_append_queue_entry_missing_location(storage, client_stub):
+    """Test appending to a deleted location raises and drops the cached copy"""
+    storage._store({'location_id': 'loc-1'})
+    client_stub.add_client_error('update_item', 'ConditionalCheckFailedException', expected_params=append_params(base=0))
+    with pytest.raises(storage.client.exceptions.ConditionalCheckFailedException):
+        storage.append_queue_entry('loc-1', {'id': 'loc-1-abcd'}, '2024-01-01T00:00:00')
+    assert storage._cache.get('loc-1') is None
+
+def test_count_locations_pages(storage, table_stub):
+    """Test counting follows scan pages and never reads items back"""
+    params = {'TableName': TABLE, 'Select': 'COUNT', 'FilterExpression': ANY}
+    table_stub.add_response(
+        'scan',
+        {'Count': 2, 'ScannedCount': 5, 'LastEvaluatedKey': {'location_id': {'S': 'loc-5'}}},
+        params
+    )
+    table_stub.add_response(
+        'scan',
+        {'Count': 1, 'ScannedCount': 3},
+        dict(params, ExclusiveStartKey={'location_id': 'loc-5'})
+    )
+    assert storage.count_locations() == (8, 3)
+
+def test_put_location_conflict(storage, table_stub):
+    """Test a conditional put on a changed item reports False instead of raising"""
+    table_stub.add_client_error('put_item', 'ConditionalCheckFailedException')
+    location = {'location_id': 'loc-1', 'updated_at': '2024-01-01T00:00:01'}
+    assert not storage.put_location(location, '2024-01-01T00:00:00')
+    assert storage._cache.get('loc-1') is None
+
+def test_serve_next_retries_on_conflict(storage, client_stub, table_stub, tmp_path):
+    """Test serving re-reads and retries when another instance wrote first"""
+    qs = QueueSystem(data_file=str(tmp_path / 'queues.msgpack'))
+    qs.dynamodb = storage
+
+    def stored(updated_at):
+        return serialized({
+            'location_id': 'loc-1',
+            'updated_at': updated_at,
+            'current_queue': [
+                {'id': 'loc-1-aaaa', 'user_name': 'Alice', 'position': 1, 'status': 'waiting'},
+                {'id': 'loc-1-bbbb', 'user_name': 'Bob', 'position': 2, 'status': 'waiting'},
+            ],
+            'active_waiting': 2,
+            'active_served': 0,
+        })
+    read = {'TableName': TABLE, 'Key': {'location_id': {'S': 'loc-1'}}, 'ConsistentRead': True}
+    write = {'TableName': TABLE, 'Item': ANY, 'ConditionExpression': ANY}
+    client_stub.add_response('get_item', {'Item': stored('2024-01-01T00:00:00')}, read)
+    table_stub.add_client_error('put_item', 'ConditionalCheckFailedException', expected_params=write)
+    client_stub.add_response('get_item', {'Item': stored('2024-01-01T00:00:05')}, read)
+    table_stub.add_response('put_item', {}, write)
+
+    served = qs.serve_next('loc-1')
+    assert served['user_name'] == 'Alice'
+    location = qs.queues['loc-1']
+    assert location['served_count'] == 1
+    assert (location['active_waiting'], location['active_served']) == (1, 1)
+
+def test_put_locations_if_unchanged_skips_changed(storage, table_stub):
+    """Test the sync writes unchanged items and skips ones changed elsewhere"""
+    params = {'TableName': TABLE, 'Item': ANY, 'ConditionExpression': ANY}
+    table_stub.add_response('put_item', {}, params)
+    table_stub.add_client_error('put_item', 'ConditionalCheckFailedException')
+    locations = [
+        {'location_id': 'loc-1', 'updated_at': '2024-01-01T00:00:00'},
+        {'location_id': 'loc-2', 'updated_at': '2024-01-01T00:00:00'},
+    ]
+    assert storage.put_locations_if_unchanged(locations) == (1, 1)
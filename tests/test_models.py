@@ -0,0 +1,38 @@
+import pytest
+import models
+from models import User
+
+@pytest.fixture
+def user():
+    models._verified_passwords.clear()
+    return User.create('cache-test', 'correct horse')
+
+def cached_keys(user):
+    return [k for k in models._verified_passwords if k[0] == user.id]
+
+def test_check_password_caches_success(user, monkeypatch):
+    """Test a verified password skips the KDF on the next check"""
+    assert user.check_password('correct horse')
+    assert cached_keys(user) == [(user.id, user.password_hash)]
+
+    def fail(*args):
+        raise AssertionError('KDF should not run for a cached password')
+    monkeypatch.setattr(models, 'check_password_hash', fail)
+    assert user.check_password('correct horse')
+
+def test_check_password_failures_not_cached(user):
+    """Test wrong passwords are rejected and never cached"""
+    assert not user.check_password('wrong')
+    assert not user.check_password('')
+    assert cached_keys(user) == []
+    # A cached success does not let a different password through
+    assert user.check_password('correct horse')
+    assert not user.check_password('wrong')
+
+def test_set_password_evicts_cache(user):
+    """Test changing the password drops the cached verdict"""
+    assert user.check_password('correct horse')
+    user.set_password('battery staple')
+    assert cached_keys(user) == []
+    assert not user.check_password('correct horse')
+    assert user.check_password('battery staple')
@@ -0,0 +1,196 @@
+import copy
+import io
+import orjson
+import pytest
+from decimal import Decimal
+from werkzeug.datastructures import FileStorage
+from queue_system import QueueSystem
+
+@pytest.fixture
+def qs(tmp_path):
+    """Queue system on a local file, no AWS involved"""
+    return QueueSystem(data_file=str(tmp_path / 'queues.msgpack'))
+
+@pytest.fixture
+def location_id(qs):
+    return qs.create_location('Front Desk', 'Test Description', 10)
+
+def counters(qs, location_id):
+    location = qs.get_location(location_id)
+    return location['active_waiting'], location['active_served']
+
+def recount(location):
+    """Counters as a full walk of the queue would compute them"""
+    location = copy.deepcopy(location)
+    QueueSystem._refresh_queue_counters(location)
+    return location['active_waiting'], location['active_served']
+
+def test_join_queue_positions(qs, location_id):
+    """Test joining assigns increasing positions"""
+    first = qs.join_queue(location_id, 'Alice')
+    second = qs.join_queue(location_id, 'Bob')
+    assert qs.get_queue_position(location_id, first)['position'] == 1
+    status = qs.get_queue_position(location_id, second)
+    assert status['position'] == 2
+    assert status['total_in_queue'] == 2
+    assert [e['user_name'] for e in qs.get_queue_list(location_id)] == ['Alice', 'Bob']
+
+def test_join_unknown_location(qs):
+    """Test joining a location that doesn't exist"""
+    assert qs.join_queue('missing', 'Alice') is None
+
+def test_serve_next_in_order(qs, location_id):
+    """Test serving takes people in position order"""
+    qs.join_queue(location_id, 'Alice')
+    second = qs.join_queue(location_id, 'Bob')
+    served = qs.serve_next(location_id)
+    assert served['user_name'] == 'Alice'
+    assert served['status'] == 'served'
+    assert qs.get_queue_position(location_id, second)['total_in_queue'] == 1
+    assert qs.serve_next(location_id)['user_name'] == 'Bob'
+    assert qs.serve_next(location_id) is None
+    assert qs.get_location(location_id)['served_count'] == 2
+
+def test_leave_queue_renumbers(qs, location_id):
+    """Test leaving moves everyone behind up one place"""
+    first = qs.join_queue(location_id, 'Alice')
+    second = qs.join_queue(location_id, 'Bob')
+    third = qs.join_queue(location_id, 'Carol')
+    assert qs.leave_queue(location_id, first)
+    assert qs.get_queue_position(location_id, first) is None
+    assert qs.get_queue_position(location_id, second)['position'] == 1
+    assert qs.get_queue_position(location_id, third)['position'] == 2
+    # Leaving twice is refused
+    assert not qs.leave_queue(location_id, first)
+
+def test_changes_persist_to_file(qs, location_id):
+    """Test a new queue system sees the saved queue"""
+    queue_id = qs.join_queue(location_id, 'Alice')
+    reloaded = QueueSystem(data_file=qs.data_file)
+    assert reloaded.get_queue_position(location_id, queue_id)['position'] == 1
+
+def test_waiting_entries_tracks_appends(qs, location_id):
+    """Test the waiting deque picks up joins and skips entries changed behind its back"""
+    first = qs.join_queue(location_id, 'Alice')
+    location = qs.get_location(location_id)
+    assert [e['id'] for e in qs._waiting_entries(location)] == [first]
+    second = qs.join_queue(location_id, 'Bob')
+    assert [e['id'] for e in qs._waiting_entries(location)] == [first, second]
+    qs.get_queue_entry(location, first)['status'] = 'served'
+    assert [e['id'] for e in qs._waiting_entries(location)] == [second]
+
+def test_waiting_entries_new_queue_list(qs, location_id):
+    """Test a replaced queue list is re-read in position order"""
+    location = qs.get_location(location_id)
+    location['current_queue'] = [
+        {'id': 'b', 'status': 'waiting', 'position': 2},
+        {'id': 'x', 'status': 'left', 'position': 0},
+        {'id': 'a', 'status': 'waiting', 'position': 1},
+    ]
+    assert [e['id'] for e in qs._waiting_entries(location)] == ['a', 'b']
+
+def test_get_queue_entry_index(qs, location_id):
+    """Test entry lookups see entries appended after the index was built"""
+    first = qs.join_queue(location_id, 'Alice')
+    location = qs.get_location(location_id)
+    assert qs.get_queue_entry(location, first)['user_name'] == 'Alice'
+    second = qs.join_queue(location_id, 'Bob')
+    assert qs.get_queue_entry(location, second)['user_name'] == 'Bob'
+    assert qs.get_queue_entry(location, 'nobody') is None
+
+def test_running_counters(qs, location_id):
+    """Test counters move with each join, serve and leave"""
+    first = qs.join_queue(location_id, 'Alice')
+    qs.join_queue(location_id, 'Bob')
+    qs.join_queue(location_id, 'Carol')
+    assert counters(qs, location_id) == (3, 0)
+    qs.serve_next(location_id)
+    assert counters(qs, location_id) == (2, 1)
+    qs.leave_queue(location_id, qs.get_queue_list(location_id)[0]['id'])
+    assert counters(qs, location_id) == (1, 1)
+    assert qs.get_queue_position(location_id, first) is None
+
+def test_counters_do_not_drift(qs, location_id):
+    """Test the running counters always match a full recount"""
+    queue_ids = []
+    for i in range(20):
+        queue_ids.append(qs.join_queue(location_id, f'Person {i}'))
+        if i % 3 == 0:
+            qs.serve_next(location_id)
+        if i % 4 == 1:
+            qs.leave_queue(location_id, queue_ids[-1])
+        # Leaving someone already served is refused and must not count
+        qs.leave_queue(location_id, queue_ids[0])
+        assert counters(qs, location_id) == recount(qs.get_location(location_id))
+    stats = qs.get_all_stats()[location_id]
+    assert stats['waiting_count'] == recount(qs.get_location(location_id))[0]
+
+def test_missing_counters_are_recounted(qs, location_id):
+    """Test locations written before the counters existed are still counted"""
+    qs.join_queue(location_id, 'Alice')
+    location = qs.get_location(location_id)
+    del location['active_waiting']
+    del location['active_served']
+    assert qs.waiting_count(location) == 1
+    assert qs.get_location_counts() == (1, 1)
+
+def test_legacy_json_migration(tmp_path):
+    """Test a JSON queue file is read and the next save writes msgpack"""
+    legacy = {
+        'loc-1': {
+            'location_id': 'loc-1',
+            'name': 'Legacy',
+            'current_queue': [{'id': 'loc-1-abcd', 'user_name': 'Alice', 'position': 1, 'status': 'waiting'}],
+            'served_count': 0,
+            'updated_at': '2024-01-01T00:00:00',
+        }
+    }
+    (tmp_path / 'queues.json').write_bytes(orjson.dumps(legacy))
+    qs = QueueSystem(data_file=str(tmp_path / 'queues.msgpack'))
+    assert qs.queues == legacy
+    assert qs.get_queue_position('loc-1', 'loc-1-abcd')['position'] == 1
+
+    qs.save_queues()
+    assert (tmp_path / 'queues.msgpack').exists()
+    (tmp_path / 'queues.json').unlink()
+    assert QueueSystem(data_file=qs.data_file).queues == qs.queues
+
+def test_queue_file_keeps_integers(qs):
+    """Test DynamoDB's Decimals read back from the queue file as ints"""
+    qs.queues = {'loc-1': {'location_id': 'loc-1', 'served_count': Decimal('3'), 'capacity': Decimal('2.5'),
+                           'current_queue': [{'position': Decimal('1')}]}}
+    qs.save_queues()
+    reloaded = QueueSystem(data_file=qs.data_file).queues['loc-1']
+    assert reloaded['served_count'] == 3 and isinstance(reloaded['served_count'], int)
+    assert reloaded['capacity'] == 2.5
+    assert isinstance(reloaded['current_queue'][0]['position'], int)
+
+@pytest.mark.parametrize('mimetype, stored', [
+    ('image/png', 'image/png'),
+    ('application/pdf', 'application/pdf'),
+    ('text/html', 'application/octet-stream'),
+    ('image/svg+xml', 'application/octet-stream'),
+])
+def test_receipt_content_type(qs, mimetype, stored):
+    """Test only images and PDFs keep their content type on S3"""
+    uploads = []
+    class FakeS3:
+        def upload_file_obj(self, file_obj, s3_key, extra_args=None):
+            uploads.append((s3_key, extra_args))
+    qs.s3 = FakeS3()
+    receipt = FileStorage(io.BytesIO(b'data'), filename='receipt.bin', content_type=mimetype)
+    assert qs._save_receipt_file(receipt, 'abcdefgh-1234') == 'receipts/receipt_abcdefgh-1234.bin'
+    assert uploads == [('receipts/receipt_abcdefgh-1234.bin', {'ContentType': stored})]
+
+def test_location_from_queue_id(qs, location_id):
+    """Test queue IDs map back to their location through the prefix index"""
+    queue_id = qs.join_queue(location_id, 'Alice')
+    assert qs.get_location_from_queue_id(queue_id) == location_id
+    assert qs.get_location_from_queue_id('unknown-1234') is None
+    qs.delete_location(location_id)
+    assert qs.get_location_from_queue_id(queue_id) is None
+
+def test_location_from_queue_id_rebuilds_on_miss(qs):
+    """Test locations cached without the index are still found"""
+    qs.queues['abcdefgh-1234'] = {'location_id': 'abcdefgh-1234', 'current_queue': []}
+    assert qs.get_location_from_queue_id('abcdefgh-5678') == 'abcdefgh-1234'